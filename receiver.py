@@ -1,8 +1,18 @@
+import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from models import Song
+from utils import call_with_backoff, create_http_session, get_first_word
+
+# Maximum number of playlist pages requested from Spotify at the same time
+MAX_CONCURRENT_REQUESTS = 5
+# Largest page size accepted by the playlist items endpoint
+PLAYLIST_PAGE_SIZE = 100
+# Only request the track fields we actually read, keeping responses small
+PLAYLIST_ITEM_FIELDS = "items(track(id,name,external_urls.spotify)),total"
 
 
 def authenticate_spotify():
@@ -23,6 +33,8 @@ def authenticate_spotify():
             "Missing SPOTIPY_CLIENT_ID or SPOTIPY_CLIENT_SECRET in environment."
         )
 
+    session = create_http_session(pool_maxsize=MAX_CONCURRENT_REQUESTS)
+
     # Create a credential manager
     auth_manager = SpotifyOAuth(
         client_id=CLIENT_ID,
@@ -30,10 +42,12 @@ def authenticate_spotify():
         redirect_uri=REDIRECT_URI,
         scope=SCOPE,
         cache_path=".spotifycache",
+        requests_session=session,
     )
 
-    # Setup the main spotify object
-    sp = spotipy.Spotify(auth_manager=auth_manager)
+    # Setup the main spotify object, sharing one connection pool for all API calls
+    sp = spotipy.Spotify(
+        auth_manager=auth_manager, requests_session=session, requests_timeout=5)
     return sp
 
 
@@ -68,11 +82,28 @@ def get_songs_from_playlist(sp: spotipy.Spotify, playlist_url: str) -> list[Song
     # Extract playlist ID from the URL
     playlist_id = playlist_url.split("/")[-1].split("?")[0]
 
+    def fetch_page(offset: int) -> dict:
+        return call_with_backoff(
+            sp.playlist_items,
+            playlist_id,
+            fields=PLAYLIST_ITEM_FIELDS,
+            offset=offset,
+            limit=PLAYLIST_PAGE_SIZE,
+            additional_types=("track",),
+        )
+
+    # The first page tells us how many items the playlist holds
+    first_page = fetch_page(0)
+    offsets = range(PLAYLIST_PAGE_SIZE, first_page["total"], PLAYLIST_PAGE_SIZE)
+
+    # Fetch the remaining pages concurrently; map() keeps them in playlist order
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        pages = [first_page, *executor.map(fetch_page, offsets)]
+
     songs: list[Song] = []
 
-    results = sp.playlist_items(playlist_id)
-    while results:
-        for item in results["items"]:
+    for page in pages:
+        for item in page["items"]:
             track = item.get("track")
             if not track:
                 continue
@@ -90,23 +121,18 @@ def get_songs_from_playlist(sp: spotipy.Spotify, playlist_url: str) -> list[Song
                 )
                 songs.append(song)
 
-        if results.get("next"):
-            results = sp.next(results)
-        else:
-            results = None
-
     return songs
 
 
-def decode_first_word_encoding(songs: list[Song]) -> str:
-    """Decode a message from songs using the First Word encoding scheme."""
+def decode_first_word_encoding(names: list[str]) -> str:
+    """Decode a message from song names using the First Word encoding scheme."""
     words: list[str] = []
 
-    for song in songs:
-        if not song.name:
+    for name in names:
+        if not name:
             continue
 
-        first_word = song.name.split()[0].strip('.,!?;"\'')
+        first_word = get_first_word(name)
         if first_word:
             words.append(first_word)
 
@@ -114,27 +140,22 @@ def decode_first_word_encoding(songs: list[Song]) -> str:
 
 
 def decode_hex_encoding(
-    songs: list[Song],
+    track_ids: list[str],
     first_index: int = 5,
     second_index: int = 8,
 ) -> str:
-    """Decode a message from songs using the Hex encoding scheme."""
-    hex_bytes: list[str] = []
-
-    for song in songs:
-        track_id = song.track_id
-
-        # Safety check in case playlist was modified
-        if len(track_id) <= max(first_index, second_index):
-            raise Exception(
-                f"Track ID '{track_id}' is too short to contain indices "
-                f"{first_index} and {second_index}."
-            )
-
-        byte = track_id[first_index] + track_id[second_index]
-        hex_bytes.append(byte)
+    """Decode a message from song track IDs using the Hex encoding scheme."""
+    # Safety check in case playlist was modified
+    shortest = min(track_ids, key=len, default="")
+    if track_ids and len(shortest) <= max(first_index, second_index):
+        raise Exception(
+            f"Track ID '{shortest}' is too short to contain indices "
+            f"{first_index} and {second_index}."
+        )
 
-    hex_string = "".join(hex_bytes)
+    # Each track ID carries one byte, split across the two indexes
+    hex_string = "".join(
+        track_id[first_index] + track_id[second_index] for track_id in track_ids)
 
     try:
         decoded_bytes = bytes.fromhex(hex_string)
@@ -177,28 +198,56 @@ def get_second_index() -> int:
                 print("Index out of range. Please enter a number between 0 and 21.")
 
 
+def playlist_url_arg(value: str) -> str:
+    """Validate a playlist URL given on the command line."""
+    if not value.startswith("https://open.spotify.com/playlist/"):
+        raise argparse.ArgumentTypeError("invalid Spotify playlist URL")
+    return value
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line. Options left out are asked for interactively."""
+    parser = argparse.ArgumentParser(
+        description="Decode a message hidden in the songs of a Spotify playlist.")
+    parser.add_argument("--playlist-url", type=playlist_url_arg,
+                        help="Spotify playlist URL to read from")
+    parser.add_argument("--encoding", choices=["1", "2"],
+                        help="(1) First Word Encoding, (2) Hex Encoding")
+    parser.add_argument("--first-index", type=int, choices=range(22), metavar="0-21",
+                        help="First track ID index for hex encoding")
+    parser.add_argument("--second-index", type=int, choices=range(22), metavar="0-21",
+                        help="Second track ID index for hex encoding")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()  # Command line options, prompted for when missing
+
     sp = authenticate_spotify()  # The main Spotify client
 
-    playlist_url = get_playlist_url()  # Playlist to read from
-    encoding = get_encoding_method()   # Encoding scheme used
+    playlist_url = args.playlist_url or get_playlist_url()  # Playlist to read from
+    encoding = args.encoding or get_encoding_method()       # Encoding scheme used
 
     songs = get_songs_from_playlist(sp, playlist_url)
 
+    # The decoders each only need one field, so pull the columns out once
+    names = [song.name for song in songs]
+    track_ids = [song.track_id for song in songs]
+
     print("\nSongs found in playlist (in order):")
-    print([song.name for song in songs])
+    print(names)
 
     if not songs:
         print("\nNo songs found in the playlist.")
         exit(0)
 
     if encoding == "1":
-        message = decode_first_word_encoding(songs)
+        message = decode_first_word_encoding(names)
     elif encoding == "2":
-        first_index = get_first_index()
-        second_index = get_second_index()
+        first_index = args.first_index if args.first_index is not None else get_first_index()
+        second_index = args.second_index if args.second_index is not None else get_second_index()
         message = decode_hex_encoding(
-            songs, first_index=first_index, second_index=second_index)
+            track_ids, first_index=first_index, second_index=second_index)
     else:
         # Should never happen due to validation in get_encoding_method
         raise Exception("Unknown encoding method.")
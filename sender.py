@@ -1,11 +1,28 @@
+import argparse
+import atexit
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from spotipy.oauth2 import SpotifyOAuth
 import spotipy
 import os
 from dotenv import load_dotenv
-import json
+import orjson
+import pickle
 from models import Song
+from utils import call_with_backoff, create_http_session, get_first_word
 import csv
+import hashlib
+from collections import defaultdict
+from functools import lru_cache
+
+# Maximum number of Spotify searches running at the same time
+MAX_CONCURRENT_REQUESTS = 5
+# Maximum number of Spotify searches started per second, across all workers
+MAX_REQUESTS_PER_SECOND = 10
+# Largest number of items Spotify accepts per playlist read or write request
+PLAYLIST_PAGE_SIZE = 100
 
 
 def authenticate_spotify():
@@ -26,12 +43,15 @@ def authenticate_spotify():
             "Missing SPOTIPY_CLIENT_ID or SPOTIPY_CLIENT_SECRET in environment."
         )
 
+    session = create_http_session(pool_maxsize=MAX_CONCURRENT_REQUESTS)
+
     # Create a credential manager
     auth_manager = SpotifyOAuth(
-        client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI, scope=SCOPE, cache_path=".spotifycache")
+        client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI, scope=SCOPE, cache_path=".spotifycache", requests_session=session)
 
-    # Setup the main spotify object
-    sp = spotipy.Spotify(auth_manager=auth_manager)
+    # Setup the main spotify object, sharing one connection pool for all API calls
+    sp = spotipy.Spotify(
+        auth_manager=auth_manager, requests_session=session, requests_timeout=5)
     return sp
 
 
@@ -44,72 +64,234 @@ def get_current_user_id(sp: spotipy.Spotify):
         raise RuntimeError("Failed to get current user from Spotify API.")
 
 
+class RateLimiter:
+    """Leaky bucket limiter spacing out calls made from several threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the caller is allowed to make its next request."""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        # Sleep outside the lock so other workers can reserve their own slots
+        time.sleep(slot - now)
+
+
+search_rate_limiter = RateLimiter(MAX_REQUESTS_PER_SECOND)
+
+
+def rate_limited_search(sp: spotipy.Spotify, **kwargs) -> dict:
+    """Run a Spotify search once search_rate_limiter grants it a slot."""
+    search_rate_limiter.wait()
+    return sp.search(**kwargs)
+
+
 def load_song_cache(path=".cache") -> dict:
     """Load the song cache from the .cache file if it exists."""
     if not os.path.exists(path) or os.path.getsize(path) == 0:
         return {}
 
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
 
 
 def save_song_cache(cache: dict, path=".cache"):
     """Save the song cache to the .cache file."""
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(cache, f, indent=4, ensure_ascii=False)
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(cache, option=orjson.OPT_INDENT_2))
+
+
+# The song cache is read once per run and written back when the program exits
+song_cache = load_song_cache()
+song_cache_modified = False
+
+
+def flush_song_cache():
+    """Write the in-memory song cache to disk if it changed during this run."""
+    if song_cache_modified:
+        save_song_cache(song_cache)
+
+
+atexit.register(flush_song_cache)
+
+
+def index_cache_path(name: str, source_path: str) -> str:
+    """Return the pickle path for an index named `name` built from `source_path`."""
+    # Key on the dataset's location too, so indexes of different datasets never mix
+    source_key = hashlib.sha1(os.path.abspath(
+        source_path).encode("utf-8")).hexdigest()[:10]
+    return f".dataset_index_{name}_{source_key}.pkl"
+
+
+def load_index_cache(path: str, source_path: str) -> dict | None:
+    """Load a pickled index if it exists and is newer than the file it was built from."""
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source_path):
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (pickle.UnpicklingError, EOFError):
+        # A damaged cache is rebuilt like a missing one
+        return None
+
+
+def save_index_cache(index: dict, path: str):
+    """Pickle an index so later runs can skip rebuilding it."""
+    # Write to a temporary file first so an interrupted run never leaves a truncated cache
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def read_dataset_tracks(path="dataset.csv"):
+    """Yield the (track_id, track_name) pair of every row in the dataset."""
+    with open(path, encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+
+        # Resolve the column positions once instead of building a dict per row
+        header = next(reader)
+        track_id_column = header.index('track_id')
+        track_name_column = header.index('track_name')
+
+        for row in reader:
+            yield row[track_id_column], row[track_name_column]
+
+
+@lru_cache(maxsize=None)
+def load_first_word_index(path="dataset.csv") -> dict[str, list[tuple[str, str]]]:
+    """Group the dataset's (track_id, track_name) pairs by the lowercased first word of the track name."""
+    cache_path = index_cache_path("words", path)
+
+    # Reuse the index built by a previous run unless the dataset changed since
+    index = load_index_cache(cache_path, path)
+    if index is not None:
+        return index
+
+    index = defaultdict(list)
+
+    for track_id, track_name in read_dataset_tracks(path):
+        first_word = get_first_word(track_name)
+        if first_word:
+            index[first_word.lower()].append((track_id, track_name))
+
+    index = dict(index)
+    save_index_cache(index, cache_path)
 
+    return index
 
-def get_song_from_first_word(word: str, sp: spotipy.Spotify) -> Song | None:
-    """Search for a track by the first word and return the raw API response."""
-    word = word.strip('.,!?;"\'').split()[0]  # Get the first word only
-    song = None
 
-    cache = load_song_cache()
+def prefer_exact_case(word: str, songs: list[Song]) -> list[Song]:
+    """Keep only the songs whose first word matches the word's casing, if there are any."""
+    exact = [song for song in songs if get_first_word(song.name) == word]
+    return exact or songs
+
+
+def get_songs_from_first_word(word: str, sp: spotipy.Spotify) -> list[Song]:
+    """Search for tracks whose first word matches the given word and return them all."""
+    global song_cache_modified
 
     # Check if the word is already in the cache
-    if cache.get(word):
+    if song_cache.get(word):
         print(f"Found '{word}' in cache. Using cached data...")
-        song = random.choice(cache[word])
-        return Song(song["track_id"], song["name"], song["spotify_url"])
-    # If not in cache, search Spotify
+        return [Song(song["track_id"], song["name"], song["spotify_url"]) for song in song_cache[word]]
+    # Then check the local dataset, which needs no API call
+    elif dataset_songs := load_first_word_index().get(word.lower()):
+        print(f"Found '{word}' in dataset. Using dataset songs...")
+        # The index is case-insensitive, so keep the message's casing where the dataset allows
+        return prefer_exact_case(word, [Song(
+            track_id=track_id, name=track_name, spotify_url="https://open.spotify.com/track/" + track_id
+        ) for track_id, track_name in dataset_songs])
+    # If not found locally, search Spotify
     else:
         print(f"Searching Spotify for the word '{word}'...")
-        results = sp.search(q=f'"{word}"', type='track', limit=10)
+        # Every attempt, including retries after a 429, waits for its own slot
+        results = call_with_backoff(
+            rate_limited_search, sp, q=f'"{word}"', type='track', limit=10)
 
         if results:
             songs = [Song(
                 track_id=song['id'], name=song['name'], spotify_url=song['external_urls']['spotify']
-            ) for song in results['tracks']['items'] if song['name'].split()[0].strip('.,!?;"\'').lower() == word.lower()]
+            ) for song in results['tracks']['items'] if get_first_word(song['name']).lower() == word.lower()]
+            songs = prefer_exact_case(word, songs)
 
             if not songs:
-                return None
-
-            cache[word] = [song.to_dict() for song in songs]
+                return []
 
-            # Update the cache file
-            save_song_cache(cache)
+            # Saved to the cache file on exit by flush_song_cache
+            song_cache[word] = [song.to_dict() for song in songs]
+            song_cache_modified = True
 
-            return random.choice(songs)
+            return songs
         # No song exists for the word
         else:
-            return None
+            return []
 
 
-def get_first_word_encoding_songs(message: str, sp: spotipy.Spotify) -> list[Song]:
+def get_first_word_encoding_songs(message: str, sp: spotipy.Spotify, max_workers: int = MAX_CONCURRENT_REQUESTS) -> list[Song]:
     """Get a list of songs corresponding to the first words in the message."""
     songs = []
-
-    for word in message.split():
-        song = get_song_from_first_word(word.strip(), sp)
-        if song:
-            print(f"Found song: {song.name}")
-            songs.append(song)
-        else:
+    words = [get_first_word(word) for word in message.split()]
+    # Words made only of punctuation have nothing to encode
+    words = [word for word in words if word]
+
+    # Look up each distinct word only once, however often it appears in the message.
+    # Cache and dataset hits return immediately, while the Spotify searches for the misses run concurrently,
+    # paced by search_rate_limiter to stay within Spotify's request quota.
+    unique_words = list(dict.fromkeys(words))
+    word_index = load_first_word_index()  # Load the dataset index once, before the worker threads use it
+
+    # If any word needs a Spotify search, authenticate before starting the workers.
+    # Otherwise each of them would start its own login server or token refresh.
+    if any(not song_cache.get(word) and word.lower() not in word_index for word in unique_words):
+        get_current_user_id(sp)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        candidates = dict(zip(unique_words, executor.map(
+            lambda word: get_songs_from_first_word(word, sp), unique_words)))
+
+    for word in unique_words:
+        if not candidates[word]:
             raise Exception(f"No songs found for the word '{word}'.")
 
+    # Pick a song per occurrence so repeated words still map to varied songs
+    for word in words:
+        song = random.choice(candidates[word])
+        print(f"Found song: {song.name}")
+        songs.append(song)
+
     return songs
 
 
+@lru_cache(maxsize=None)
+def load_dataset_index(first_index: int, second_index: int, path="dataset.csv") -> dict[str, list[tuple[str, str]]]:
+    """Group the dataset's (track_id, track_name) pairs by the hex byte found at the given track ID indexes."""
+    cache_path = index_cache_path(f"{first_index}_{second_index}", path)
+
+    # Reuse the index built by a previous run unless the dataset changed since
+    index = load_index_cache(cache_path, path)
+    if index is not None:
+        return index
+
+    index = defaultdict(list)
+
+    for track_id, track_name in read_dataset_tracks(path):
+        index[track_id[first_index] + track_id[second_index]].append(
+            (track_id, track_name))
+
+    index = dict(index)
+    save_index_cache(index, cache_path)
+
+    return index
+
+
 def get_hex_encoding_songs(message: str, first_index: int = 5, second_index: int = 8) -> list[Song]:
     """Get a list of songs corresponding to the hex encoding of the message."""
     songs = []
@@ -117,30 +299,91 @@ def get_hex_encoding_songs(message: str, first_index: int = 5, second_index: int
     hex_message = message.encode("utf-8").hex()
     print(f"Hex message: {hex_message}")
 
-    # Iterate byte by byte (2 hex characters) and check for songs with bytes in the corresponding track IDs indexes
+    # Parse the dataset once, grouping songs by the byte their track IDs encode
+    index = load_dataset_index(first_index, second_index)
+
+    # Iterate byte by byte (2 hex characters) and look up songs with that byte in the corresponding track IDs indexes
     for byte in [hex_message[i:i+2] for i in range(0, len(hex_message), 2)]:
-        with open("dataset.csv", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            matched_songs = [row for row in reader if row['track_id'][first_index]
-                             == byte[0] and row['track_id'][second_index] == byte[1]]
-
-            # Found songs, save them
-            if matched_songs:
-                song_data = random.choice(matched_songs)
-                song = Song(
-                    track_id=song_data['track_id'],
-                    name=song_data['track_name'],
-                    spotify_url="https://open.spotify.com/track/" +
-                    song_data['track_id']
-                )
-                print(f"Found song for byte '{byte}': {song.name}")
-                songs.append(song)
-            else:
-                raise Exception(f"No songs found for the byte '{byte}'.")
+        matched_songs = index.get(byte)
+
+        # Found songs, save them
+        if matched_songs:
+            track_id, track_name = random.choice(matched_songs)
+            song = Song(
+                track_id=track_id,
+                name=track_name,
+                spotify_url="https://open.spotify.com/track/" + track_id
+            )
+            print(f"Found song for byte '{byte}': {song.name}")
+            songs.append(song)
+        else:
+            raise Exception(f"No songs found for the byte '{byte}'.")
 
     return songs
 
 
+def get_playlist_track_uris(sp: spotipy.Spotify, playlist_id: str) -> tuple[list[str | None], str]:
+    """Fetch the URIs of the items currently in the playlist, in order, along with its snapshot ID."""
+    snapshot_id = call_with_backoff(
+        sp.playlist, playlist_id, fields="snapshot_id")["snapshot_id"]
+
+    uris = []
+
+    # Page by offset rather than following 'next', whose URL drops the fields mask
+    offset = 0
+    while True:
+        results = call_with_backoff(
+            sp.playlist_items, playlist_id, fields="items(track(uri)),next", offset=offset, limit=PLAYLIST_PAGE_SIZE)
+        uris.extend((item.get("track") or {}).get("uri")
+                    for item in results["items"])
+        if not results.get("next"):
+            break
+        offset += PLAYLIST_PAGE_SIZE
+
+    return uris, snapshot_id
+
+
+def update_playlist(sp: spotipy.Spotify, playlist_id: str, track_ids: list[str]):
+    """Make the playlist hold exactly the given tracks, only rewriting the part that changed."""
+    current, snapshot_id = get_playlist_track_uris(sp, playlist_id)
+    target = [f"spotify:track:{track_id}" for track_id in track_ids]
+
+    # Number of leading tracks that are already in the right place
+    kept = 0
+    for current_uri, target_uri in zip(current, target):
+        if current_uri != target_uri:
+            break
+        kept += 1
+
+    # Spotify removes every occurrence of a track, so the stale tail can only be deleted
+    # when none of its tracks also sit in the kept prefix. Items without a URI
+    # (e.g. unavailable local files) can't be removed individually either.
+    stale = set(current[kept:])
+    if None in stale or not stale.isdisjoint(current[:kept]):
+        kept = 0
+
+    if kept == 0:
+        # Nothing worth keeping, overwrite the playlist with the first batch
+        call_with_backoff(sp.playlist_replace_items,
+                          playlist_id, target[:PLAYLIST_PAGE_SIZE])
+        to_add = target[PLAYLIST_PAGE_SIZE:]
+    else:
+        # Remove the stale tail against the snapshot we read it from
+        stale = list(stale)
+        for start in range(0, len(stale), PLAYLIST_PAGE_SIZE):
+            snapshot_id = call_with_backoff(sp.playlist_remove_all_occurrences_of_items,
+                                            playlist_id, stale[start:start + PLAYLIST_PAGE_SIZE],
+                                            snapshot_id=snapshot_id)["snapshot_id"]
+        to_add = target[kept:]
+
+    for start in range(0, len(to_add), PLAYLIST_PAGE_SIZE):
+        call_with_backoff(sp.playlist_add_items, playlist_id,
+                          to_add[start:start + PLAYLIST_PAGE_SIZE])
+
+    print(
+        f"Kept {kept} tracks already in place, wrote {len(target) - kept}.")
+
+
 def get_message() -> str:
     """Prompt the user to enter a valid message."""
     while True:
@@ -206,23 +449,56 @@ def get_second_index() -> int:
                 print("Index out of range. Please enter a number between 0 and 21.")
 
 
+def playlist_url_arg(value: str) -> str:
+    """Validate a playlist URL given on the command line."""
+    if not value.startswith("https://open.spotify.com/playlist/"):
+        raise argparse.ArgumentTypeError("invalid Spotify playlist URL")
+    return value
+
+
+def message_arg(value: str) -> str:
+    """Validate a message given on the command line."""
+    if not value.strip():
+        raise argparse.ArgumentTypeError("message cannot be empty")
+    return value
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line. Options left out are asked for interactively."""
+    parser = argparse.ArgumentParser(
+        description="Encode a message into the songs of a Spotify playlist.")
+    parser.add_argument("--playlist-url", type=playlist_url_arg,
+                        help="Spotify playlist URL to save songs to")
+    parser.add_argument("--message", type=message_arg, help="Message to encode into songs")
+    parser.add_argument("--encoding", choices=["1", "2"],
+                        help="(1) First Word Encoding, (2) Hex Encoding")
+    parser.add_argument("--first-index", type=int, choices=range(22), metavar="0-21",
+                        help="First track ID index for hex encoding")
+    parser.add_argument("--second-index", type=int, choices=range(22), metavar="0-21",
+                        help="Second track ID index for hex encoding")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()  # Command line options, prompted for when missing
+
     sp = authenticate_spotify()  # The main spotify client
 
-    playlist_url = get_playlist_url()  # Get the playlist URL to save songs to
+    # Get the playlist URL to save songs to
+    playlist_url = args.playlist_url or get_playlist_url()
 
     # Extract the playlist ID from the URL
     playlist_id = playlist_url.split("/")[-1].split("?")[0]
 
-    message = get_message()  # Get the message to encode
-    encoding = get_encoding_method()  # Get the encoding method
+    message = args.message or get_message()  # Get the message to encode
+    encoding = args.encoding or get_encoding_method()  # Get the encoding method
 
     songs = []
     if encoding == "1":
         songs = get_first_word_encoding_songs(message, sp)
     elif encoding == "2" or encoding == "":
-        first_index = get_first_index()
-        second_index = get_second_index()
+        first_index = args.first_index if args.first_index is not None else get_first_index()
+        second_index = args.second_index if args.second_index is not None else get_second_index()
         songs = get_hex_encoding_songs(
             message, first_index=first_index, second_index=second_index)
 
@@ -230,5 +506,4 @@ if __name__ == "__main__":
     print([song.name for song in songs])
 
     if songs:
-        sp.playlist_replace_items(playlist_id, [])  # Clear existing items
-        sp.playlist_add_items(playlist_id, [song.track_id for song in songs])
+        update_playlist(sp, playlist_id, [song.track_id for song in songs])
@@ -0,0 +1,57 @@
+import time
+
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Punctuation ignored around the first word of a title.
+# Shared by the sender and receiver so both sides of the first-word channel agree.
+FIRST_WORD_PUNCTUATION = '.,!?;"\''
+
+
+def create_http_session(pool_maxsize: int) -> requests.Session:
+    """Create an HTTP session whose connections are kept alive and shared by concurrent requests."""
+    session = requests.Session()
+
+    # spotipy's default retry policy, except that rate limiting (HTTP 429) is left to
+    # call_with_backoff so it sees Spotify's Retry-After header
+    retry = Retry(
+        total=3,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=[code for code in spotipy.Spotify.default_retry_codes if code != 429],
+        respect_retry_after_header=False,
+    )
+    # Keep enough open connections for every worker thread
+    adapter = HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def call_with_backoff(func, *args, max_attempts: int = 5, **kwargs):
+    """Call a Spotify API method, waiting and retrying when rate limited (HTTP 429)."""
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return func(*args, **kwargs)
+        except spotipy.SpotifyException as e:
+            if e.http_status != 429 or attempt == max_attempts:
+                raise
+
+            # Spotify tells us how long to wait before the next request
+            retry_after = int(e.headers.get("Retry-After", 2 ** attempt))
+            print(f"Rate limited by Spotify. Retrying in {retry_after}s...")
+            time.sleep(retry_after)
+
+
+def get_first_word(text: str) -> str:
+    """Return the first whitespace-separated word of a title, without surrounding punctuation."""
+    # maxsplit=1 avoids splitting the rest of the title into words we never use
+    # Strip rather than str.translate(): deleting punctuation inside the word would turn "Don't" into "Dont"
+    words = text.split(maxsplit=1)
+    return words[0].strip(FIRST_WORD_PUNCTUATION) if words else ""